@@ -18,10 +18,14 @@
 '''
 
 import argparse
+import ast
 import asyncio
+import collections
+import concurrent.futures
 import io
+import math
 import types
-from functools import partial
+from functools import lru_cache
 
 import moteus
 import moteus.moteus_tool
@@ -35,7 +39,7 @@ import traceback
 import matplotlib
 import matplotlib.figure
 import json
-from sympy import symbols, Eq, parse_expr
+from sympy import Expr, lambdify, nan, parse_expr, symbols, zoo
 
 try:
     import PySide6
@@ -78,21 +82,62 @@ import asyncqt
 
 import moteus.reader as reader
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(value):
+        return json.dumps(value).encode('utf8')
+
+    _json_loads = json.loads
+
 
 LEFT_LEGEND_LOC = 3
 RIGHT_LEGEND_LOC = 2
 
 DEFAULT_RATE = 100
 MAX_HISTORY_SIZE = 100
+PLOT_INITIAL_CAPACITY = 1024
 MAX_SEND = 61
 POLL_TIMEOUT_S = 0.1
+IDLE_POLL_PERIOD_S = 0.01
 STARTUP_TIMEOUT_S = 0.5
+STARTUP_POLL_COUNT = 5
+
+PROPERTIES_FILE = 'tview_properties.json'
+PROPERTIES_FLUSH_DELAY_MS = 5000
+
+TREE_COLUMN_MARGIN = 8
 
 FORMAT_ROLE = QtCore.Qt.UserRole + 1
+NAME_ROLE = QtCore.Qt.UserRole + 2
+ROOT_ROLE = QtCore.Qt.UserRole + 3
 
 FMT_STANDARD = 0
 FMT_HEX = 1
 
+SIGNAL_RAW = 0
+SIGNAL_MEAN = 1
+SIGNAL_STDDEV = 2
+
+_SIGNAL_PREFIXES = [
+    ('__STDDEV_', SIGNAL_STDDEV),
+    ('__MEAN_', SIGNAL_MEAN),
+]
+
+_NEWLINE_RE = re.compile(rb'[\r\n]')
+_U32_LE = struct.Struct('<I')
+_COMMAND_SKIP_RE = re.compile(r'emit |schema ')
+_DELAY_RE = re.compile(r"^:(\d+)$")
+_DEVICE_RE = re.compile(r"^(A|\d+)>(.*)$")
+
 
 class CommandError(RuntimeError):
     def __init__(self, cmd, err):
@@ -100,20 +145,66 @@ class CommandError(RuntimeError):
 
 
 def _has_nonascii(data):
-    return any([ord(x) > 127 for x in data])
+    return not data.isascii()
 
 
 # TODO jpieper: Factor these out of tplot.py
-def _get_data(value, name):
-    fields = name.split('.')
-    for field in fields:
-        if isinstance(value, list):
-            value = value[int(field)]
-        else:
-            value = getattr(value, field)
+@lru_cache(maxsize=None)
+def _compile_path(name):
+    '''Return a tuple of (is_index, key) steps for the dotted name.'''
+    return tuple((True, int(field)) if field.isdigit() else (False, field)
+                 for field in name.split('.'))
+
+
+def _get_path_data(value, path):
+    for is_index, key in path:
+        value = value[key] if is_index else getattr(value, key)
     return value
 
 
+def _make_tree_item(parent, name):
+    '''Create a child item, recording its dotted name relative to the
+    top level device item, and its root (see _get_root_item).'''
+
+    # Fill everything in before adding the item, so that handlers for
+    # itemChanged only ever see complete items.
+    item = QtWidgets.QTreeWidgetItem()
+    item.setText(0, name)
+    parent_name = parent.data(0, NAME_ROLE)
+    item.setData(0, NAME_ROLE,
+                 f'{parent_name}.{name}' if parent_name else name)
+    if parent.parent() is not None:
+        item.setData(0, ROOT_ROLE, _get_root_item(parent))
+    parent.addChild(item)
+    return item
+
+
+def _grow_name_column(tree, item):
+    '''Widen the name column to fit the children of a just expanded
+    item.
+
+    Unlike resizeColumnToContents, this only measures the newly shown
+    items rather than everything visible, and never shrinks the
+    column.'''
+    metrics = QtGui.QFontMetrics(tree.font())
+    item_name = item.data(0, NAME_ROLE)
+    depth = 1 if item_name is None else item_name.count('.') + 2
+    if tree.rootIsDecorated():
+        depth += 1
+    text_width = max((metrics.horizontalAdvance(item.child(i).text(0))
+                      for i in range(item.childCount())), default=0)
+    width = text_width + tree.indentation() * depth + TREE_COLUMN_MARGIN
+    if width > tree.columnWidth(0):
+        tree.setColumnWidth(0, width)
+
+
+def _get_root_item(item):
+    '''Return the ancestor of item which is a direct child of the top
+    level device item, or item itself if it is one.'''
+    root = item.data(0, ROOT_ROLE)
+    return item if root is None else root
+
+
 def _add_schema_item(parent, element, terminal_flags=None):
     # Cache our schema, so that we can use it for things like
     # generating better input options.
@@ -123,8 +214,7 @@ def _add_schema_item(parent, element, terminal_flags=None):
         for field in element.fields:
             name = field.name
 
-            item = QtWidgets.QTreeWidgetItem(parent)
-            item.setText(0, name)
+            item = _make_tree_item(parent, name)
 
             _add_schema_item(item, field.type_class,
                              terminal_flags=terminal_flags)
@@ -132,16 +222,23 @@ def _add_schema_item(parent, element, terminal_flags=None):
         if terminal_flags:
             parent.setFlags(terminal_flags)
 
-def _set_tree_widget_data(item, struct, element, terminal_flags=None):
+def _set_tree_widget_data(item, struct, element, terminal_flags=None,
+                          pending=None):
     if (isinstance(element, reader.ObjectType) or
         isinstance(element, reader.ArrayType) or
         isinstance(element, reader.FixedArrayType)):
         if not isinstance(element, reader.ObjectType):
             for i in range(item.childCount(), len(struct)):
-                subitem = QtWidgets.QTreeWidgetItem(item)
-                subitem.setText(0, str(i))
+                subitem = _make_tree_item(item, str(i))
                 _add_schema_item(subitem, element.type_class,
                                  terminal_flags=terminal_flags)
+        if pending is not None and not item.isExpanded():
+            # Nothing below here is visible.  Remember the data, by
+            # item name, so that it can be filled in when the item is
+            # expanded.  This is not kept on the item, as any setData
+            # would repaint it.
+            pending[item.data(0, NAME_ROLE)] = (struct, element)
+            return
         for i in range(item.childCount()):
             child = item.child(i)
             if isinstance(struct, list):
@@ -152,7 +249,8 @@ def _set_tree_widget_data(item, struct, element, terminal_flags=None):
                 field = getattr(struct, name)
                 child_element = element.fields[i].type_class
             _set_tree_widget_data(child, field, child_element,
-                                  terminal_flags=terminal_flags)
+                                  terminal_flags=terminal_flags,
+                                  pending=pending)
     else:
         maybe_format = item.data(1, FORMAT_ROLE)
         text = None
@@ -160,7 +258,148 @@ def _set_tree_widget_data(item, struct, element, terminal_flags=None):
             text = f"{struct:x}"
         else:
             text = repr(struct)
-        item.setText(1, text)
+        # Every setText results in a repaint of the row, even when
+        # nothing changed.
+        if item.text(1) != text:
+            item.setText(1, text)
+
+
+if numba is None:
+    def _mean_std(data, count):
+        values = data[:count]
+        return numpy.mean(values), numpy.std(values)
+else:
+    # For windows this short, numpy's per-call overhead dominates, so
+    # a compiled loop is much faster.  fastmath is not used, as it
+    # would not respect NaN values in telemetry.
+    @numba.njit(cache=True)
+    def _mean_std(data, count):
+        total = 0.0
+        for i in range(count):
+            total += data[i]
+        mean = total / count
+        variance = 0.0
+        for i in range(count):
+            delta = data[i] - mean
+            variance += delta * delta
+        return mean, (variance / count) ** 0.5
+
+
+# Names which, called with a single argument, mean the same thing
+# to sympy and can be evaluated directly with numpy.
+_FORMULA_NAMESPACE = {
+    'pi': numpy.pi,
+    'E': numpy.e,
+    'sin': numpy.sin,
+    'cos': numpy.cos,
+    'tan': numpy.tan,
+    'asin': numpy.arcsin,
+    'acos': numpy.arccos,
+    'atan': numpy.arctan,
+    'sinh': numpy.sinh,
+    'cosh': numpy.cosh,
+    'tanh': numpy.tanh,
+    'exp': numpy.exp,
+    'log': numpy.log,
+    'sqrt': numpy.sqrt,
+    'Abs': numpy.abs,
+    'abs': numpy.abs,
+}
+_FORMULA_NAMES = frozenset(_FORMULA_NAMESPACE) | {'x'}
+
+
+def _compile_formula(formula):
+    '''Return a function which evaluates formula over an array of x
+    values.
+
+    Formulas that only use x and the names above are evaluated with
+    numpy directly, anything else goes through sympy.'''
+
+    # Constants are common enough that they shouldn't need any
+    # evaluation at all.  float() also accepts spellings like 'inf'
+    # which sympy does not, so leave anything non-finite to sympy.
+    try:
+        value = float(formula)
+    except ValueError:
+        pass
+    else:
+        if math.isfinite(value):
+            return lambda xs: value
+
+    try:
+        tree = ast.parse(formula, mode='eval')
+    except SyntaxError:
+        tree = None
+
+    if tree is not None and _is_numpy_formula(tree):
+        code = compile(tree, '<formula>', 'eval')
+        fallback = None
+
+        def evaluate(xs):
+            nonlocal fallback
+            try:
+                return eval(code, {'__builtins__': {}},
+                            dict(_FORMULA_NAMESPACE, x=xs))
+            except (TypeError, ValueError, ArithmeticError):
+                # Python semantics don't always match sympy's, for
+                # instance 1/0, so let sympy have the final say.
+                if fallback is None:
+                    fallback = _compile_sympy_formula(formula)
+                return fallback(xs)
+        return evaluate
+
+    return _compile_sympy_formula(formula)
+
+
+_FORMULA_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow)
+_FORMULA_UNARYOPS = (ast.UAdd, ast.USub)
+
+
+def _is_numpy_formula(node):
+    '''Return True if the parsed formula only has arithmetic on x,
+    numbers and the names above, which numpy evaluates the same way
+    sympy would.'''
+    if isinstance(node, ast.Expression):
+        return _is_numpy_formula(node.body)
+    if isinstance(node, ast.BinOp):
+        return (isinstance(node.op, _FORMULA_BINOPS) and
+                _is_numpy_formula(node.left) and
+                _is_numpy_formula(node.right))
+    if isinstance(node, ast.UnaryOp):
+        return (isinstance(node.op, _FORMULA_UNARYOPS) and
+                _is_numpy_formula(node.operand))
+    if isinstance(node, ast.Call):
+        # The numpy functions take their second argument as an
+        # output array, whereas sympy's log(x, b) has base b.
+        return (isinstance(node.func, ast.Name) and
+                node.func.id in _FORMULA_NAMESPACE and
+                len(node.args) == 1 and not node.keywords and
+                _is_numpy_formula(node.args[0]))
+    if isinstance(node, ast.Name):
+        return node.id in _FORMULA_NAMES
+    if isinstance(node, ast.Constant):
+        # bool is an int, but sympy doesn't treat it as a number.
+        return type(node.value) in (int, float)
+    return False
+
+
+def _compile_sympy_formula(formula):
+    expr = parse_expr(formula, evaluate=True)
+    # Comparisons and booleans can't be used as positions.
+    if not isinstance(expr, Expr):
+        raise TypeError(f'formula is not a numeric expression: {expr!r}')
+    # These have no numpy equivalent for lambdify to use.
+    if expr.has(zoo, nan):
+        raise TypeError('formula is undefined')
+    fn = lambdify(symbols('x'), expr, modules=['numpy'])
+
+    def evaluate_sympy(xs):
+        try:
+            return fn(xs)
+        except TypeError:
+            # Some functions only have scalar implementations.
+            return [float(fn(float(x))) for x in xs]
+    return evaluate_sympy
 
 
 def _console_escape(value):
@@ -201,8 +440,15 @@ class PlotItem(object):
         self.plot_widget = plot_widget
         self.name = name
         self.line = None
-        self.xdata = []
-        self.ydata = []
+
+        # The samples in the window are xdata[start:end].  Keeping
+        # them in preallocated arrays means matplotlib does not have
+        # to convert a list on every update.
+        self.xdata = numpy.empty(PLOT_INITIAL_CAPACITY)
+        self.ydata = numpy.empty(PLOT_INITIAL_CAPACITY)
+        self._start = 0
+        self._end = 0
+
         self.connection = signal.connect(self._handle_update)
 
     def _make_line(self):
@@ -230,6 +476,25 @@ class PlotItem(object):
             self.axis.legend(loc=self.axis.legend_loc)
         self.plot_widget.canvas.draw()
 
+    def _append(self, x, y):
+        if self._end == len(self.xdata):
+            # Move the window back to the front, growing the arrays if
+            # it takes up more than half of them.
+            count = self._end - self._start
+            if count > len(self.xdata) // 2:
+                xdata = numpy.empty(len(self.xdata) * 2)
+                ydata = numpy.empty(len(self.ydata) * 2)
+            else:
+                xdata, ydata = self.xdata, self.ydata
+            xdata[0:count] = self.xdata[self._start:self._end]
+            ydata[0:count] = self.ydata[self._start:self._end]
+            self.xdata, self.ydata = xdata, ydata
+            self._start, self._end = 0, count
+
+        self.xdata[self._end] = x
+        self.ydata[self._end] = y
+        self._end += 1
+
     def _handle_update(self, value):
         if self.plot_widget.paused:
             return
@@ -238,26 +503,20 @@ class PlotItem(object):
             self._make_line()
 
         now = time.time()
-        self.xdata.append(now)
-        self.ydata.append(value)
+        self._append(now, value)
 
         # Remove elements from the beginning until there is at most
-        # one before the window.
+        # one before the window.  Times are monotonic, so we can
+        # bisect for the cutoff.
         oldest_time = now - self.plot_widget.history_s
-        oldest_index = None
-        for i in range(len(self.xdata)):
-            if self.xdata[i] >= oldest_time:
-                oldest_index = i - 1
-                break
-
-        if oldest_index and oldest_index > 1:
-            self.xdata = self.xdata[oldest_index:]
-            self.ydata = self.ydata[oldest_index:]
+        oldest_index = numpy.searchsorted(
+            self.xdata[self._start:self._end], oldest_time) - 1
 
-        self.line.set_data(self.xdata, self.ydata)
+        if oldest_index > 1:
+            self._start += oldest_index
 
-        self.axis.relim()
-        self.axis.autoscale()
+        self.line.set_data(self.xdata[self._start:self._end],
+                           self.ydata[self._start:self._end])
 
         self.plot_widget.data_update()
 
@@ -272,7 +531,13 @@ class PlotWidget(QtWidgets.QWidget):
         self.next_color = 0
         self.paused = False
 
-        self.last_draw_time = 0.0
+        # Updates from all plot items are coalesced into at most one
+        # redraw per timer interval.
+        self._dirty = False
+        self._draw_timer = QtCore.QTimer(self)
+        self._draw_timer.setInterval(100)
+        self._draw_timer.timeout.connect(self._maybe_draw)
+        self._draw_timer.start()
 
         self.figure = matplotlib.figure.Figure()
         self.canvas = FigureCanvas(self.figure)
@@ -318,11 +583,18 @@ class PlotWidget(QtWidgets.QWidget):
         item.remove()
 
     def data_update(self):
-        now = time.time()
-        elapsed = now - self.last_draw_time
-        if elapsed > 0.1:
-            self.last_draw_time = now
-            self.canvas.draw()
+        self._dirty = True
+
+    def _maybe_draw(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+
+        for _, axis in self._get_axes_keys():
+            axis.relim()
+            axis.autoscale()
+
+        self.canvas.draw_idle()
 
     def _get_axes_keys(self):
         result = []
@@ -403,36 +675,70 @@ class TviewConsoleWidget(HistoryConsoleWidget):
         return True
 
 
+class RingBuffer:
+    def __init__(self, size):
+        self._data = numpy.empty(size, dtype=numpy.float64)
+        self._index = 0
+        self._filled = 0
+
+    def append(self, value):
+        size = len(self._data)
+        self._data[self._index] = value
+        self._index = (self._index + 1) % size
+        self._filled = min(self._filled + 1, size)
+
+    def mean_std(self):
+        # The order of values is not preserved, which is fine for
+        # these statistics.
+        return _mean_std(self._data, self._filled)
+
+
 class Record:
     def __init__(self, archive):
         self.archive = archive
         self.tree_item = None
         self.signals = {}
-        self.history = []
+        self.history = collections.deque(maxlen=MAX_HISTORY_SIZE)
+
+        # The latest (struct, element) for each collapsed item of
+        # tree_item, by name.
+        self.pending = {}
+
+        # A list of (signal, kind, path, ring) for every signal, with
+        # the name already resolved.  Statistics signals keep the
+        # values they care about in their own ring buffer, so we only
+        # have to extract one new value per update.
+        self._specs = []
 
     def get_signal(self, name):
         if name not in self.signals:
-            self.signals[name] = RecordSignal()
+            signal = RecordSignal()
+            self.signals[name] = signal
+
+            for prefix, kind in _SIGNAL_PREFIXES:
+                if name.startswith(prefix):
+                    path = _compile_path(name[len(prefix):])
+                    ring = RingBuffer(MAX_HISTORY_SIZE)
+                    for x in self.history:
+                        ring.append(_get_path_data(x, path))
+                    break
+            else:
+                kind, path, ring = SIGNAL_RAW, _compile_path(name), None
+
+            self._specs.append((signal, kind, path, ring))
 
         return self.signals[name]
 
     def update(self, struct):
         count = 0
         self.history.append(struct)
-        if len(self.history) > MAX_HISTORY_SIZE:
-            self.history = self.history[1:]
-
-        for key, signal in self.signals.items():
-            if key.startswith('__STDDEV_'):
-                remaining = key.split('__STDDEV_')[1]
-                values = [_get_data(x, remaining) for x in self.history]
-                value = numpy.std(values)
-            elif key.startswith('__MEAN_'):
-                remaining = key.split('__MEAN_')[1]
-                values = [_get_data(x, remaining) for x in self.history]
-                value = numpy.mean(values)
-            else:
-                value = _get_data(struct, key)
+
+        for signal, kind, path, ring in self._specs:
+            value = _get_path_data(struct, path)
+            if kind != SIGNAL_RAW:
+                ring.append(value)
+                mean, std = ring.mean_std()
+                value = mean if kind == SIGNAL_MEAN else std
             if signal.update(value):
                 count += 1
         return count != 0
@@ -482,37 +788,52 @@ class EditDelegate(QtWidgets.QStyledItemDelegate):
 
 
 def _get_item_name(item):
-    name = item.text(0)
-    while item.parent() and item.parent().parent():
-        name = item.parent().text(0) + '.' + name
-        item = item.parent()
-
-    return name
+    return item.data(0, NAME_ROLE)
 
 
 def _get_item_root(item):
-    while item.parent().parent():
-        item = item.parent()
-    return item.text(0)
+    return _get_root_item(item).text(0)
 
 
 class DeviceStream:
-    def __init__(self, transport, controller):
-        self._write_data = b''
-        self._read_data = b''
+    def __init__(self, transport, controller, write_event=None):
+        # These are consumed from the front and appended to at the
+        # back, so keep them mutable to avoid copying on every append.
+        self._write_data = bytearray()
+        self._read_data = bytearray()
         self.transport = transport
         self.controller = controller
 
-        self._read_condition = asyncio.Condition()
+        self._read_event = asyncio.Event()
+        self._write_event = write_event
 
         self.emit_count = 0
         self.poll_count = 0
+        self.reply_count = 0
+
+        self._startup_ready = asyncio.Event()
+        self._startup_drained = asyncio.Event()
+
+    async def wait_for_startup(self):
+        '''Wait until we have written at least once and had replies to
+        a few polls since, and then until a reply comes back empty,
+        meaning anything left over from before has been drained.  If
+        the device never goes quiet, stop waiting for that after
+        STARTUP_TIMEOUT_S.'''
+        await self._startup_ready.wait()
+        try:
+            await asyncio.wait_for(self._startup_drained.wait(),
+                                   timeout=STARTUP_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            pass
 
     def ignore_all(self):
-        self._read_data = b''
+        self._read_data.clear()
 
     def write(self, data):
-        self._write_data += data
+        self._write_data.extend(data)
+        if self._write_event:
+            self._write_event.set()
 
     async def poll(self):
         self.poll_count += 1
@@ -524,8 +845,8 @@ class DeviceStream:
 
         self.emit_count += 1
 
-        to_write, self._write_data = (
-            self._write_data[0:MAX_SEND], self._write_data[MAX_SEND:])
+        to_write = bytes(self._write_data[0:MAX_SEND])
+        del self._write_data[0:MAX_SEND]
         await self.transport.write(self.controller.make_diagnostic_write(to_write))
 
     async def process_message(self, message):
@@ -544,21 +865,33 @@ class DeviceStream:
         if datalen > (len(data) - 3):
             return False
 
-        self._read_data += data[3:3+datalen]
+        self._read_data.extend(data[3:3+datalen])
+        self._read_event.set()
 
-        async with self._read_condition:
-            self._read_condition.notify_all()
+        # Polls go out after writes in each cycle, so only replies
+        # after the first write count towards startup.
+        if self.emit_count:
+            self.reply_count += 1
+            if self.reply_count >= STARTUP_POLL_COUNT:
+                self._startup_ready.set()
+                if datalen == 0:
+                    self._startup_drained.set()
 
         return datalen > 0
 
+    async def _wait_for_data(self):
+        # Callers have already looked at everything in _read_data, so
+        # only new data should wake us up.
+        self._read_event.clear()
+        await self._read_event.wait()
+
     def _read_maybe_empty_line(self):
-        first_newline = min((self._read_data.find(c) for c in b'\r\n'
-                             if c in self._read_data), default=None)
-        if first_newline is None:
+        match = _NEWLINE_RE.search(self._read_data)
+        if match is None:
             return
-        to_return, self._read_data = (
-            self._read_data[0:first_newline+1],
-            self._read_data[first_newline+1:])
+        end = match.end()
+        to_return = bytes(self._read_data[0:end])
+        del self._read_data[0:end]
         return to_return
 
     async def readline(self):
@@ -568,33 +901,30 @@ class DeviceStream:
                 maybe_line = maybe_line.rstrip()
                 if len(maybe_line) > 0:
                     return maybe_line
-            async with self._read_condition:
-                await self._read_condition.wait()
+            await self._wait_for_data()
 
     async def resynchronize(self):
         while True:
             oldlen = len(self._read_data)
-            async with self._read_condition:
-                await self._read_condition.wait()
+            await self._wait_for_data()
             newlen = len(self._read_data)
             if newlen == oldlen:
-                self._read_data = b''
+                self._read_data.clear()
                 return
 
     async def read_sized_block(self):
         while True:
             if len(self._read_data) >= 5:
-                size = struct.unpack('<I', self._read_data[1:5])[0]
+                size = _U32_LE.unpack_from(self._read_data, 1)[0]
                 if size > 2 ** 24:
                     return False
 
                 if len(self._read_data) >= (5 + size):
-                    block = self._read_data[5:5+size]
-                    self._read_data = self._read_data[5+size:]
+                    block = bytes(self._read_data[5:5+size])
+                    del self._read_data[0:5+size]
                     return block
 
-            async with self._read_condition:
-                await self._read_condition.wait()
+            await self._wait_for_data()
 
 
 class Device:
@@ -613,7 +943,8 @@ class Device:
         self.controller = moteus.Controller(number, can_prefix=can_prefix)
         self._main_window = main_window
         self._transport = transport
-        self._stream = DeviceStream(transport, self.controller)
+        self._stream = DeviceStream(transport, self.controller,
+                                    main_window.write_event)
 
         self._console = console
         self._prefix = prefix
@@ -632,8 +963,7 @@ class Device:
         self.write('\r\ntel stop\r\n'.encode('latin1'))
 
         # Make sure we've actually had a chance to write and poll.
-        while self._stream.poll_count < 5 or self._stream.emit_count < 1:
-            await asyncio.sleep(0.2)
+        await self._stream.wait_for_startup()
 
         self._stream.ignore_all()
 
@@ -643,8 +973,6 @@ class Device:
 
         if self._schema_config:
             self._main_window.add_devices_user_function(self.number)
-            self._main_window.ui.pushButtonStartAll.clicked.connect(partial(self._main_window._handle_start, [self.number]))
-            self._main_window.ui.pushButtonStopAll.clicked.connect(partial(self._main_window._handle_stop, [self.number]))
 
         await self.run()
 
@@ -669,10 +997,17 @@ class Device:
                 pass
 
             configs = await self.command('conf enumerate')
-            for config in configs.split('\n'):
-                if config.strip() == '':
-                    continue
-                self.add_config_line(config)
+
+            # Don't repaint after every single insert.
+            tree = self._config_tree_item.treeWidget()
+            tree.setUpdatesEnabled(False)
+            try:
+                for config in configs.split('\n'):
+                    if config.strip() == '':
+                        continue
+                    self.add_config_line(config)
+            finally:
+                tree.setUpdatesEnabled(True)
         finally:
             self._updating_config = False
 
@@ -687,8 +1022,7 @@ class Device:
             data = await self.read_data(element)
 
             archive = reader.Type.from_binary(io.BytesIO(schema), name=element)
-            item = QtWidgets.QTreeWidgetItem(self._config_tree_item)
-            item.setText(0, element)
+            item = _make_tree_item(self._config_tree_item, element)
 
             flags = (QtCore.Qt.ItemIsEditable |
                      QtCore.Qt.ItemIsSelectable |
@@ -740,22 +1074,12 @@ class Device:
 
 
     async def read_schema(self, name):
+        wanted = frozenset([f'schema {name}', f'cschema {name}'])
         while True:
             line = await self.readline()
             if line.startswith('ERR'):
                 raise CommandError('', line)
-            if not (line == f'schema {name}' or line == f'schema {name}'):
-                continue
-            break
-        schema = await self.read_sized_block()
-        return schema
-
-    async def read_schema(self, name):
-        while True:
-            line = await self.readline()
-            if line.startswith('ERR'):
-                raise CommandError('', line)
-            if not (line == f'schema {name}' or line == f'cschema {name}'):
+            if line not in wanted:
                 continue
             break
         schema = await self.read_sized_block()
@@ -783,7 +1107,9 @@ class Device:
         if record:
             struct = record.archive.read(reader.Stream(io.BytesIO(data)))
             record.update(struct)
-            _set_tree_widget_data(record.tree_item, struct, record.archive)
+
+            _set_tree_widget_data(record.tree_item, struct, record.archive,
+                                  pending=record.pending)
 
     async def read_sized_block(self):
         return await self._stream.read_sized_block()
@@ -826,11 +1152,10 @@ class Device:
         # line.
         while True:
             line = await self.readline()
-            if line.startswith('emit ') or line.startswith('schema '):
+            if _COMMAND_SKIP_RE.match(line):
                 continue
             break
 
-        now = time.time()
         while True:
             if line.startswith('ERR'):
                 raise CommandError(message, line)
@@ -839,16 +1164,13 @@ class Device:
 
             result.write(line + '\n')
             line = await self.readline()
-            end = time.time()
-            now = end
 
     def add_config_line(self, line):
         # Add it into our tree view.
         key, value = line.split(' ', 1)
         name, rest = key.split('.', 1)
         if name not in self._config_tree_items:
-            item = QtWidgets.QTreeWidgetItem(self._config_tree_item)
-            item.setText(0, name)
+            item = _make_tree_item(self._config_tree_item, name)
             self._config_tree_items[name] = item
 
         def add_config(item, key, value):
@@ -866,15 +1188,13 @@ class Device:
             if len(fields) > 1:
                 next_key = fields[1]
 
-            child = None
-            # See if we already have an appropriate child.
-            for i in range(item.childCount()):
-                if item.child(i).text(0) == this_field:
-                    child = item.child(i)
-                    break
+            # See if we already have an appropriate child.  Every
+            # item we create is indexed by its dotted name.
+            child_name = _get_item_name(item) + '.' + this_field
+            child = self._config_tree_items.get(child_name)
             if child is None:
-                child = QtWidgets.QTreeWidgetItem(item)
-                child.setText(0, this_field)
+                child = _make_tree_item(item, this_field)
+                self._config_tree_items[child_name] = child
             add_config(child, next_key, value)
 
         add_config(self._config_tree_items[name], rest, value)
@@ -906,8 +1226,7 @@ class Device:
 
 
     def _add_schema_to_tree(self, name, schema_data, record):
-        item = QtWidgets.QTreeWidgetItem(self._data_tree_item)
-        item.setText(0, name)
+        item = _make_tree_item(self._data_tree_item, name)
 
         schema = Device.Schema(name, self, record)
         item.setData(0, QtCore.Qt.UserRole, schema)
@@ -916,85 +1235,112 @@ class Device:
         return item
 
 
+class PropertyStore:
+    '''Persisted widget values, all kept in a single JSON file.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self._flush_pending = False
+
+        # Writes happen off of the GUI thread.  A single worker keeps
+        # them in order.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        try:
+            with open(path, 'rb') as f:
+                self.data = _json_loads(f.read())
+        except FileNotFoundError:
+            pass
+
+    def get(self, key, default, legacy_field=None):
+        '''Return the value for key.  If it has not been stored yet,
+        and legacy_field is given, take it from the per-widget
+        <key>.property file that older versions wrote.'''
+        if key not in self.data and legacy_field is not None:
+            try:
+                with open(key + '.property', 'rb') as f:
+                    self.set(key, _json_loads(f.read())[legacy_field])
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+        # Coalesce a burst of changes into one write.
+        if not self._flush_pending:
+            self._flush_pending = True
+            QtCore.QTimer.singleShot(PROPERTIES_FLUSH_DELAY_MS, self.flush)
+
+    def flush(self, wait=False):
+        '''Write out the current values in the background.  If wait is
+        True, block until this and any earlier writes are done.'''
+        self._flush_pending = False
+
+        # Serialize on this thread, so the worker gets a consistent
+        # snapshot.
+        future = self._executor.submit(self._write, _json_dumps(self.data))
+        if wait:
+            future.result()
+        else:
+            future.add_done_callback(self._check_write)
+
+    def _write(self, data):
+        # Replace the old file atomically so that an interrupted write
+        # can't lose everything.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def _check_write(self, future):
+        if future.exception():
+            print("Error saving properties:", str(future.exception()))
+
+
 class CustomDoubleSpinBox(QtWidgets.QDoubleSpinBox):
 
-    def __init__(self, id: str, name: str):
+    def __init__(self, store: PropertyStore, id: str, name: str):
         super().__init__()
         self.def_value = -1.0
-        self.file_name = id + '_' + name + '.property'
-        try:
-            self.properties = self._load_properties()
-        except FileNotFoundError:
-            properties = {'value': self.def_value}
-            with open(self.file_name, 'w') as f:
-                json.dump(properties, f)
-            self.properties = self._load_properties()
-        super().setValue(float(self.properties['value']))
-
-    def _load_properties(self):
-        properties = {}
-        with open(self.file_name, 'r') as f:
-            properties = json.load(f)
-        return properties
+        self.store = store
+        self.key = id + '_' + name
+        super().setValue(float(
+            self.store.get(self.key, self.def_value, 'value')))
+        self.valueChanged.connect(self.save_properties)
 
     def save_properties(self):
-        properties = {'value': super().value()}
-        with open(self.file_name, 'w') as f:
-            json.dump(properties, f)
+        self.store.set(self.key, super().value())
 
 
 class CustomTextEdit(QtWidgets.QTextEdit):
 
-    def __init__(self, id: str, name: str):
+    def __init__(self, store: PropertyStore, id: str, name: str):
         super().__init__()
         self.def_value = ''
-        self.file_name = id + '_' + name + '.property'
-        try:
-            self.properties = self._load_properties()
-        except FileNotFoundError:
-            properties = {'text': self.def_value}
-            with open(self.file_name, 'w') as f:
-                json.dump(properties, f)
-            self.properties = self._load_properties()
-        super().setText(self.properties['text'])
-
-    def _load_properties(self):
-        properties = {}
-        with open(self.file_name, 'r') as f:
-            properties = json.load(f)
-        return properties
+        self.store = store
+        self.key = id + '_' + name
+        super().setText(self.store.get(self.key, self.def_value, 'text'))
+        self.textChanged.connect(self.save_properties)
 
     def save_properties(self):
-        properties = {'text': super().toPlainText()}
-        with open(self.file_name, 'w') as f:
-            json.dump(properties, f)
+        self.store.set(self.key, super().toPlainText())
 
 
 class CustomSpinBox(QtWidgets.QSpinBox):
 
-    def __init__(self, id: str, name: str):
+    def __init__(self, store: PropertyStore, id: str, name: str):
         super().__init__()
         self.def_value = -1
-        self.file_name = id + '_' + name + '.property'
-        try:
-            self.properties = self._load_properties()
-        except FileNotFoundError:
-            properties = {'value': self.def_value}
-            with open(self.file_name, 'w') as f:
-                json.dump(properties, f)
-            self.properties = self._load_properties()
-        super().setValue(int(self.properties['value']))
-
-    def _load_properties(self):
-        properties = {}
-        with open(self.file_name, 'r') as f:
-            properties = json.load(f)
-        return properties
+        self.store = store
+        self.key = id + '_' + name
+        super().setValue(int(
+            self.store.get(self.key, self.def_value, 'value')))
+        self.valueChanged.connect(self.save_properties)
 
     def save_properties(self):
-        properties = {'value': super().value()}
-        with open(self.file_name, 'w') as f:
-            json.dump(properties, f)
+        self.store.set(self.key, super().value())
 
 
 class TviewMainWindow():
@@ -1002,7 +1348,9 @@ class TviewMainWindow():
         self.options = options
         self.port = None
         self.devices = []
+        self._devices_by_id = {}
         self.default_rate = 100
+        self.properties = PropertyStore(PROPERTIES_FILE)
 
         current_script_dir = os.path.dirname(os.path.abspath(__file__))
         uifilename = os.path.join(current_script_dir, "tview_main_window.ui")
@@ -1051,11 +1399,23 @@ class TviewMainWindow():
         self.ui.user_context = dict()
 
         self.ui.usersTable = QtWidgets.QTableWidget()
+        # The (x, y) items of each row in usersTable, which are reused
+        # every time it is shown.
+        self._user_items = []
         self.ui.verticalLayoutUserFunction.addWidget(self.ui.usersTable)
         self.ui.pushButtonStartAll = QtWidgets.QPushButton('Start All')
         self.ui.verticalLayoutUserFunction.addWidget(self.ui.pushButtonStartAll)
         self.ui.pushButtonStopAll = QtWidgets.QPushButton('Stop All')
         self.ui.verticalLayoutUserFunction.addWidget(self.ui.pushButtonStopAll)
+        self.ui.pushButtonStartAll.clicked.connect(self._handle_start_all)
+        self.ui.pushButtonStopAll.clicked.connect(self._handle_stop_all)
+
+        # The per device Show/Start/Stop buttons are each collected in
+        # a group, using the device id as the button id, so that one
+        # connection serves every device.
+        self._show_buttons = self._make_device_button_group(self._handle_show)
+        self._start_buttons = self._make_device_button_group(self._handle_start)
+        self._stop_buttons = self._make_device_button_group(self._handle_stop)
 
         def update_plotwidget(value):
             self.ui.plotWidget.history_s = value
@@ -1066,17 +1426,31 @@ class TviewMainWindow():
     def _get_ids(self):
         return [device.number for device in self.devices]
 
+    def _get_devices(self, ids):
+        return [self._devices_by_id[x] for x in ids
+                if x in self._devices_by_id]
+
+    def _make_device_button_group(self, handler):
+        group = QtWidgets.QButtonGroup(self.ui)
+        group.setExclusive(False)
+        group.buttonClicked.connect(
+            lambda button: handler([group.id(button)]))
+        return group
+
     def add_devices_user_function(self, id):
         uc = types.SimpleNamespace()
         uc.status = True
-        uc.times = []
-        uc.positions = []
+        uc.times = numpy.empty(0)
+        uc.positions = numpy.empty(0)
+        uc.deltas = numpy.empty(0)
+        uc.formula = None
+        uc.formula_fn = None
 
         layout = QtWidgets.QHBoxLayout()
         deviceGroup = QtWidgets.QGroupBox(str(id) + ':')
         # X Start
         group_box_start = QtWidgets.QGroupBox('X Start')
-        uc.startPosition = CustomDoubleSpinBox(str(id), 'x_start')
+        uc.startPosition = CustomDoubleSpinBox(self.properties, str(id), 'x_start')
         uc.startPosition.setMinimumWidth(60)
         uc.startPosition.setMaximumHeight(20)
         uc.startPosition.setMinimum(0)
@@ -1089,7 +1463,7 @@ class TviewMainWindow():
         layout.addWidget(group_box_start)
         # X Stop
         group_box_stop = QtWidgets.QGroupBox('X Stop')
-        uc.endPosition = CustomDoubleSpinBox(str(id), 'x_stop')
+        uc.endPosition = CustomDoubleSpinBox(self.properties, str(id), 'x_stop')
         uc.endPosition.setMinimumWidth(60)
         uc.endPosition.setMaximumHeight(20)
         uc.endPosition.setMinimum(0)
@@ -1102,7 +1476,7 @@ class TviewMainWindow():
         layout.addWidget(group_box_stop)
         # Y Formula
         group_box_formula = QtWidgets.QGroupBox('Y Formula')
-        uc.usersFormula = CustomTextEdit(str(id), 'y_formula')
+        uc.usersFormula = CustomTextEdit(self.properties, str(id), 'y_formula')
         uc.usersFormula.setMaximumHeight(20)
         group_layout = QtWidgets.QVBoxLayout()
         group_layout.addWidget(uc.usersFormula)
@@ -1110,7 +1484,7 @@ class TviewMainWindow():
         layout.addWidget(group_box_formula)
         # Torque
         group_box_stop = QtWidgets.QGroupBox('Torque')
-        uc.torque = CustomDoubleSpinBox(str(id), 'torque')
+        uc.torque = CustomDoubleSpinBox(self.properties, str(id), 'torque')
         uc.torque.setMinimumWidth(60)
         uc.torque.setMaximumHeight(20)
         uc.torque.setMinimum(0)
@@ -1123,7 +1497,7 @@ class TviewMainWindow():
         layout.addWidget(group_box_stop)
         # Points
         group_box_points = QtWidgets.QGroupBox('Points')
-        uc.dots = CustomSpinBox(str(id), 'points')
+        uc.dots = CustomSpinBox(self.properties, str(id), 'points')
         uc.dots.setMaximumHeight(20)
         uc.dots.setMinimum(1)
         uc.dots.setMaximum(10_000)
@@ -1137,13 +1511,13 @@ class TviewMainWindow():
         group_box_control = QtWidgets.QGroupBox('Control')
         layout_buttons = QtWidgets.QHBoxLayout()
         button_view = QtWidgets.QPushButton('Show')
-        button_view.clicked.connect(partial(self._handle_show, [id]))
+        self._show_buttons.addButton(button_view, id)
         uc.buttonShow = button_view
         button_start = QtWidgets.QPushButton('Start')
-        button_start.clicked.connect(partial(self._handle_start, [id]))
+        self._start_buttons.addButton(button_start, id)
         uc.buttonStart = button_start
         button_stop = QtWidgets.QPushButton('Stop')
-        button_stop.clicked.connect(partial(self._handle_stop, [id]))
+        self._stop_buttons.addButton(button_stop, id)
         uc.buttonStop = button_stop
         for btn in [button_view, button_start, button_stop]:
             btn.setMaximumHeight(20)
@@ -1165,6 +1539,7 @@ class TviewMainWindow():
             uc.torque.save_properties()
             uc.dots.save_properties()
             uc.usersFormula.save_properties()
+        self.properties.flush(wait=True)
 
     def _make_transport(self):
         # Get a transport as configured.
@@ -1172,9 +1547,12 @@ class TviewMainWindow():
 
     def _open(self):
         self.transport = self._make_transport()
+        self.write_event = asyncio.Event()
         asyncio.create_task(self._run_transport())
 
         self.devices = []
+        self._devices_by_id = {}
+
         self.ui.configTreeWidget.clear()
         self.ui.telemetryTreeWidget.clear()
 
@@ -1198,31 +1576,40 @@ class TviewMainWindow():
             asyncio.create_task(device.start())
 
             self.devices.append(device)
+            self._devices_by_id[device_id] = device
 
     def _handle_startup(self):
         self.console._control.setFocus()
         self._open()
 
-    async def _dispatch_until(self, predicate):
-        while True:
+    async def _dispatch_until_replied(self, pending, data_read):
+        '''Dispatch received messages until every device number in
+        pending has replied.  Numbers are removed from pending as
+        replies arrive, and added to data_read for replies with data,
+        so both stay valid if this is cancelled.'''
+        while pending:
             message = await self.transport.read()
             if message is None:
                 continue
             source_id = (message.arbitration_id >> 8) & 0xff
-            any_data_read = False
-            for device in self.devices:
-                if device.number == source_id:
-                    any_data_read = await device.process_message(message)
-                    break
-            if predicate(message):
-                return any_data_read
+            device = self._devices_by_id.get(source_id)
+            if device and await device.process_message(message):
+                data_read.add(source_id)
+            pending.discard(source_id)
 
     async def _run_transport(self):
         any_data_read = False
         while True:
-            # We only sleep if no devices had anything to report the last cycle.
+            # We only sleep if no devices had anything to report the
+            # last cycle, and wake up early if there is something new
+            # to write.
             if not any_data_read:
-                await asyncio.sleep(0.01)
+                try:
+                    await asyncio.wait_for(self.write_event.wait(),
+                                           timeout=IDLE_POLL_PERIOD_S)
+                except asyncio.TimeoutError:
+                    pass
+            self.write_event.clear()
 
             any_data_read = await self._run_transport_iteration()
 
@@ -1235,37 +1622,49 @@ class TviewMainWindow():
             await device.emit_any_writes()
 
         # Then poll for new data.  Back off from unresponsive devices
-        # so that they don't disrupt everything.
+        # so that they don't disrupt everything.  All polls go out
+        # before we wait for any replies, so that a cycle costs one
+        # round trip rather than one per device.
+        polled = []
         for device in self.devices:
             if device.poll_count:
                 device.poll_count -= 1
                 continue
 
             await device.poll()
+            polled.append(device)
 
-            try:
-                this_data_read = await asyncio.wait_for(
-                    self._dispatch_until(
-                        lambda x: (x.arbitration_id >> 8) & 0xff == device.number),
-                    timeout = POLL_TIMEOUT_S)
+        if not polled:
+            return any_data_read
 
-                device.error_count = 0
-                device.poll_count = 0
+        pending = set(device.number for device in polled)
+        data_read = set()
+        try:
+            await asyncio.wait_for(
+                self._dispatch_until_replied(pending, data_read),
+                timeout = POLL_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            pass
+        any_data_read = bool(data_read)
 
-                if this_data_read:
-                    any_data_read = True
-            except asyncio.TimeoutError:
+        for device in polled:
+            if device.number in pending:
                 # Mark this device as error-full, which will then
                 # result in backoff in polling.
                 device.error_count = min(1000, device.error_count + 1)
                 device.poll_count = device.error_count
+            else:
+                device.error_count = 0
+                device.poll_count = 0
 
         return any_data_read
 
     def make_writer(self, devices, line):
+        data = (line + '\n').encode('latin1')
+
         def write():
             for device in devices:
-                device.write((line + '\n').encode('latin1'))
+                device.write(data)
 
         return write
 
@@ -1274,8 +1673,8 @@ class TviewMainWindow():
         now = time.time()
         current_delay_ms = 0
         for line in device_lines:
-            delay_re = re.search(r"^:(\d+)$", line)
-            device_re = re.search(r"^(A|\d+)>(.*)$", line)
+            delay_re = _DELAY_RE.match(line)
+            device_re = _DEVICE_RE.match(line)
             if delay_re:
                 current_delay_ms += int(delay_re.group(1))
                 continue
@@ -1287,7 +1686,7 @@ class TviewMainWindow():
                 line = device_re.group(2)
             else:
                 device_nums = [self.devices[0].number]
-            devices = [x for x in self.devices if x.number in device_nums]
+            devices = self._get_devices(device_nums)
             writer = self.make_writer(devices, line)
 
             if current_delay_ms > 0:
@@ -1296,7 +1695,15 @@ class TviewMainWindow():
                 writer()
 
     def _handle_tree_expanded(self, item):
-        self.ui.telemetryTreeWidget.resizeColumnToContents(0)
+        schema = _get_root_item(item).data(0, QtCore.Qt.UserRole)
+        if schema:
+            pending = schema.record.pending
+            data = pending.pop(item.data(0, NAME_ROLE), None)
+            if data is not None:
+                struct, element = data
+                _set_tree_widget_data(item, struct, element, pending=pending)
+
+        _grow_name_column(self.ui.telemetryTreeWidget, item)
         user_data = item.data(0, QtCore.Qt.UserRole)
         if user_data:
             user_data.expand()
@@ -1343,11 +1750,7 @@ class TviewMainWindow():
         requested = menu.exec_(self.ui.telemetryTreeWidget.mapToGlobal(pos))
 
         if requested in plot_actions:
-            top = item
-            while top.parent().parent():
-                top = top.parent()
-
-            schema = top.data(0, QtCore.Qt.UserRole)
+            schema = _get_root_item(item).data(0, QtCore.Qt.UserRole)
             record = schema.record
 
             name = _get_item_name(item)
@@ -1382,16 +1785,13 @@ class TviewMainWindow():
             pass
 
     def _handle_config_expanded(self, item):
-        self.ui.configTreeWidget.resizeColumnToContents(0)
+        _grow_name_column(self.ui.configTreeWidget, item)
 
     def _handle_config_item_changed(self, item, column):
         if not item.parent():
             return
 
-        top = item
-        while top.parent():
-            top = top.parent()
-
+        top = _get_root_item(item).parent()
         device = top.data(0, QtCore.Qt.UserRole)
         device.config_item_changed(_get_item_name(item), item.text(1),
                                    item.data(1, QtCore.Qt.UserRole))
@@ -1407,114 +1807,137 @@ class TviewMainWindow():
         self.ui.plotItemCombo.removeItem(index)
 
     def _handle_prepare(self, ids: list):
-        for device in self.devices:
-            if device.number in ids:
-                uc = self.ui.user_context.get(device.number)
-                start_position = float(uc.startPosition.value())
-                end_position = float(uc.endPosition.value())
-                dots = int(uc.dots.value())
-                formula = uc.usersFormula.toPlainText()
-                formula = formula.replace('^', '**')
-                x, y = symbols('x'), symbols('y')
-                uc.times = []
-                uc.positions = []
-                try:
-                    equation = Eq(y, parse_expr(formula, evaluate=True))
-                    for value in numpy.linspace(start_position, end_position, num=dots):
-                        inp = float(value)
-                        res = float(equation.subs(x, inp).rhs)
-                        uc.times.append(inp)
-                        uc.positions.append(res)
-                except SyntaxError as e:
-                    self.console.add_text('Error the formula syntax or the formula is empty: ' + str(e) + '\n')
-                except TypeError as e:
-                    self.console.add_text('Error the formula variables or the formula is not readable: ' + str(e) + '\n')
+        for device in self._get_devices(ids):
+            uc = self.ui.user_context.get(device.number)
+            start_position = float(uc.startPosition.value())
+            end_position = float(uc.endPosition.value())
+            dots = int(uc.dots.value())
+            formula = uc.usersFormula.toPlainText()
+            formula = formula.replace('^', '**')
+            uc.times = numpy.empty(0)
+            uc.positions = numpy.empty(0)
+            uc.deltas = numpy.empty(0)
+            try:
+                # Only compile the formula when it changes, and then
+                # evaluate it over all points with numpy.
+                if formula != uc.formula:
+                    uc.formula_fn = _compile_formula(formula)
+                    uc.formula = formula
+                xs = numpy.linspace(start_position, end_position, num=dots)
+                raw = uc.formula_fn(xs)
+                # numpy gives back NaN, or silently drops the
+                # imaginary part, where sympy would have refused.
+                if numpy.iscomplexobj(raw):
+                    raise TypeError('formula has complex values')
+                # Constant formulas give back a scalar.
+                ys = numpy.broadcast_to(
+                    numpy.asarray(raw, dtype=float), xs.shape)
+                if not numpy.isfinite(ys).all():
+                    raise TypeError('formula has non-finite values')
+                uc.times = xs
+                uc.positions = numpy.array(ys)
+                uc.deltas = numpy.diff(xs)
+            except SyntaxError as e:
+                self.console.add_text('Error the formula syntax or the formula is empty: ' + str(e) + '\n')
+            except (TypeError, NameError, ValueError, ArithmeticError) as e:
+                self.console.add_text('Error the formula variables or the formula is not readable: ' + str(e) + '\n')
 
     def _handle_show(self, ids: list):
-        for device in self.devices:
-            if device.number in ids:
-                uc = self.ui.user_context.get(device.number)
-                dots = int(uc.dots.value())
-                self._handle_prepare([device.number])
-                self.ui.usersTable.clear()
-                self.ui.usersTable.clearContents()
-                for i in range(self.ui.usersTable.rowCount()):
-                    self.ui.usersTable.removeRow(0)
-                self.ui.usersTable.setColumnCount(2)
-                self.ui.usersTable.setColumnWidth(0, 140)
-                self.ui.usersTable.setColumnWidth(1, 140)
-                self.ui.usersTable.setHorizontalHeaderLabels(['X', 'Y'])
-                try:
-                    if len(uc.times) > 0:
-                        for i in range(0, dots):
-                            num_rows = self.ui.usersTable.rowCount()
-                            self.ui.usersTable.insertRow(self.ui.usersTable.rowCount())
-                            self.ui.usersTable.setItem(num_rows, 0, QtWidgets.QTableWidgetItem(str(uc.times[i])))
-                            self.ui.usersTable.setItem(num_rows, 1, QtWidgets.QTableWidgetItem(str(uc.positions[i])))
-                except SyntaxError as e:
-                    self.console.add_text('Error the formula syntax or the formula is empty: ' + str(e) + '\n')
-                except TypeError as e:
-                    self.console.add_text('Error the formula variables or the formula is not readable: ' + str(e) + '\n')
+        for device in self._get_devices(ids):
+            uc = self.ui.user_context.get(device.number)
+            self._handle_prepare([device.number])
+
+            table = self.ui.usersTable
+            count = len(uc.times)
+            # Size the table once and fill it with updates off,
+            # rather than inserting and repainting row by row.
+            table.setSortingEnabled(False)
+            table.setUpdatesEnabled(False)
+            try:
+                table.setColumnCount(2)
+                table.setColumnWidth(0, 140)
+                table.setColumnWidth(1, 140)
+                table.setHorizontalHeaderLabels(['X', 'Y'])
+
+                # Qt deletes the items of any rows we drop.
+                del self._user_items[count:]
+                table.setRowCount(count)
+                for i, (t, pos) in enumerate(zip(uc.times.tolist(),
+                                                 uc.positions.tolist())):
+                    if i < len(self._user_items):
+                        x_item, y_item = self._user_items[i]
+                        x_item.setText(str(t))
+                        y_item.setText(str(pos))
+                    else:
+                        x_item = QtWidgets.QTableWidgetItem(str(t))
+                        y_item = QtWidgets.QTableWidgetItem(str(pos))
+                        table.setItem(i, 0, x_item)
+                        table.setItem(i, 1, y_item)
+                        self._user_items.append((x_item, y_item))
+            finally:
+                table.setUpdatesEnabled(True)
 
     def _handle_start(self, ids: list):
-        for device in self.devices:
-            if device.number in ids:
-                uc = self.ui.user_context.get(device.number)
+        for device in self._get_devices(ids):
+            uc = self.ui.user_context.get(device.number)
 
-                self._handle_prepare([device.number])
+            self._handle_prepare([device.number])
 
-                if len(uc.times) == 0:
-                    continue
+            if len(uc.times) == 0:
+                continue
 
-                async def task(_uc, _device):
-                    _uc.status = True
-                    _uc.buttonStart.setDisabled(True)
-                    length = len(_uc.times)
-                    torque = float(uc.torque.value())
-                    i = 0
+            async def task(_uc, _device):
+                _uc.status = True
+                _uc.buttonStart.setDisabled(True)
+                # Everything but the position is the same for each
+                # command, so format it once up front.
+                torque = str(float(_uc.torque.value())).replace(',', '.')
+                positions = _uc.positions.tolist()
+                delays = _uc.deltas.tolist()
 
-                    for cmd in ['conf set servo.max_position_slip 0.04\r\n',
-                                'conf set servo.default_accel_limit 3.0\r\n',
-                                'conf set servo.default_velocity_limit 2.0\r\n',
-                                'conf set servo.max_current_A 100.0\r\n',
-                                'conf set servopos.position_min -1.0\r\n',
-                                'conf set servopos.position_max 1.0\r\n']:
-                        _device.write_line(cmd)
-                        await asyncio.sleep(0.1)
+                for cmd in ['conf set servo.max_position_slip 0.04\r\n',
+                            'conf set servo.default_accel_limit 3.0\r\n',
+                            'conf set servo.default_velocity_limit 2.0\r\n',
+                            'conf set servo.max_current_A 100.0\r\n',
+                            'conf set servopos.position_min -1.0\r\n',
+                            'conf set servopos.position_max 1.0\r\n']:
+                    _device.write_line(cmd)
+                    await asyncio.sleep(0.1)
 
-                    for pos in _uc.positions:
+                for i, pos in enumerate(positions):
 
-                        # The acceleration and velocity limit could be configured as
-                        # `servo.default_accel_limit` and
-                        # `servo.default_velocity_limit`.  We will override those
-                        # configurations here on a per-command basis to ensure that
-                        # the limits are always used regardless of config.
-                        cmd = 'd pos ' + str(pos) + ' ' + '0' + ' ' + str(torque).replace(',', '.') + '\r\n'
+                    # The acceleration and velocity limit could be configured as
+                    # `servo.default_accel_limit` and
+                    # `servo.default_velocity_limit`.  We will override those
+                    # configurations here on a per-command basis to ensure that
+                    # the limits are always used regardless of config.
+                    _device.write_line(f'd pos {pos} 0 {torque}\r\n')
 
-                        _device.write_line(cmd)
+                    if i >= len(delays) or not _uc.status:
+                        break
 
-                        if i + 1 >= length or not _uc.status:
-                            break
+                    await asyncio.sleep(delays[i])
+                _uc.buttonStart.setDisabled(False)
 
-                        await asyncio.sleep(_uc.times[i + 1] - _uc.times[i])
+            asyncio.create_task(task(uc, device))
 
-                        i += 1
-                    _uc.buttonStart.setDisabled(False)
+    def _handle_start_all(self):
+        self._handle_start(list(self.ui.user_context.keys()))
 
-                asyncio.create_task(task(uc, device))
+    def _handle_stop_all(self):
+        self._handle_stop(list(self.ui.user_context.keys()))
 
     def _handle_stop(self, ids: list):
-        for device in self.devices:
-            if device.number in ids:
-                uc = self.ui.user_context.get(device.number)
-                uc.status = False
+        for device in self._get_devices(ids):
+            uc = self.ui.user_context.get(device.number)
+            uc.status = False
 
-                async def task(_device):
-                    for cmd in ['d stop\r\n']:
-                        _device.write_line(cmd)
-                        await asyncio.sleep(0.1)
+            async def task(_device):
+                for cmd in ['d stop\r\n']:
+                    _device.write_line(cmd)
+                    await asyncio.sleep(0.1)
 
-                asyncio.create_task(task(device))
+            asyncio.create_task(task(device))
 
 
 def main():
@@ -0,0 +1,56 @@
+#!/usr/bin/python3 -B
+
+# Copyright 2023 mjbots Robotic Systems, LLC.  info@mjbots.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import numpy
+
+from moteus_gui import tview
+
+
+class CompileFormulaTest(unittest.TestCase):
+    def test_numeric(self):
+        xs = numpy.linspace(1.0, 3.0, num=5)
+        _TESTS = [
+            ('2', 2.0 * numpy.ones(5)),
+            ('2*x + 1', 2 * xs + 1),
+            ('-x/2', -xs / 2),
+            ('sin(x)**2', numpy.sin(xs) ** 2),
+            ('log(x, 2)', numpy.log2(xs)),
+            ('log(x + 1, 10)', numpy.log10(xs + 1)),
+        ]
+
+        for formula, expected in _TESTS:
+            with self.subTest(formula=formula):
+                actual = numpy.broadcast_to(
+                    numpy.asarray(tview._compile_formula(formula)(xs),
+                                  dtype=float), xs.shape)
+                numpy.testing.assert_allclose(actual, expected)
+
+    def test_not_readable(self):
+        # These were all reported as unreadable before formulas were
+        # evaluated with numpy, and still must be.
+        xs = numpy.linspace(1.0, 3.0, num=5)
+        for formula in ['x > 0.5', 'True', 'x[0]', 'not x', '1/0',
+                        'x if x > 0 else 0']:
+            with self.subTest(formula=formula):
+                with self.assertRaises(TypeError):
+                    tview._compile_formula(formula)(xs)
+
+
+if __name__ == '__main__':
+    unittest.main()